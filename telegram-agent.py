@@ -20,11 +20,16 @@ Config: .agent-loop/telegram.json
 import json
 import logging
 import os
+import queue
+import re
 import subprocess
 import sys
 import threading
 import time
+from collections import deque
+from collections.abc import Callable
 from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
 
 try:
@@ -37,11 +42,27 @@ except ImportError:
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter, Retry
 except ImportError:
     print("Error: requests not installed. Run: pip install -r requirements.txt",
           file=sys.stderr)
     sys.exit(1)
 
+try:
+    import orjson  # optional: faster parsing of updates, claude output and state
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+else:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
 
 # ---------------------------------------------------------------------------
 # Paths
@@ -52,11 +73,15 @@ CONFIG_PATH = AGENT_DIR / "telegram.json"
 SESSIONS_PATH = AGENT_DIR / "telegram-sessions.json"
 STATE_PATH = AGENT_DIR / "telegram-state.json"
 
+# The locks guard compound operations only: check-and-set / dequeue on the
+# active maps, and mutate-then-save on sessions. Single dict operations (get,
+# pop) are atomic on their own and run without them.
 _sessions_lock = threading.Lock()
 _active_tasks: dict[int, str] = {}
 _active_tasks_lock = threading.Lock()
 
-_active_chats: dict[int, bool] = {}
+# chat_id -> messages waiting behind the chat's in-flight turn
+_active_chats: dict[int, deque[str]] = {}
 _active_chats_lock = threading.Lock()
 
 
@@ -76,117 +101,223 @@ def load_config() -> dict:
     with CONFIG_PATH.open() as f:
         cfg = json.load(f)
 
+    # Resolve defaults once so the per-message paths can index cfg directly.
+    cfg.setdefault("mode", "auto")
+    cfg.setdefault("model", "sonnet")
+    cfg.setdefault("system_prompt", "You are a helpful assistant.")
+    cfg.setdefault("task_timeout_seconds", 600)
+    cfg.setdefault("task_model", "opus")
+    cfg.setdefault("persistent_sessions", True)
+    cfg.setdefault("worker_idle_seconds", _WORKER_IDLE_SECONDS)
+    cfg.setdefault("stream_replies", False)
+    cfg.setdefault("max_sessions", _MAX_SESSIONS)
+    cfg.setdefault("chat_workers", 4)
+    cfg.setdefault("task_workers", 2)
+
     token_env = cfg.get("token_env", "telegram_token")
     allowed_env = cfg.get("allowed_ids_env", "telegram_allowed_ids")
 
     cfg["_token"] = os.environ.get(token_env, "")
     raw_ids = os.environ.get(allowed_env, "")
-    cfg["_allowed_ids"] = {int(x.strip()) for x in raw_ids.split(",") if x.strip()}
+    cfg["_allowed_ids"] = frozenset(int(x) for x in raw_ids.split(",") if x.strip())
 
     if not cfg["_token"]:
         print(f"Error: Set ${token_env} in your .env file.\n"
               "Get a token from @BotFather on Telegram.", file=sys.stderr)
         sys.exit(1)
 
+    if cfg["max_sessions"] < 1:
+        print("Error: max_sessions must be at least 1.", file=sys.stderr)
+        sys.exit(1)
+
     if not cfg["_allowed_ids"]:
         logging.warning(
             "SECURITY WARNING: telegram_allowed_ids is empty — "
             "anyone can trigger Claude. Set it to your Telegram user ID."
         )
 
-    # Load SOUL.md if it exists
-    soul_path = Path(cfg.get("soul_path", "SOUL.md"))
-    if soul_path.exists():
-        cfg["_soul"] = soul_path.read_text()
-        cfg["_soul_path"] = str(soul_path)
+    # Load SOUL.md if it exists (an empty soul_path disables it)
+    soul_path = cfg.get("soul_path", "SOUL.md") or ""
+    cfg["_soul_path"] = soul_path
+    if soul_path and Path(soul_path).is_file():
+        cfg["_soul"] = Path(soul_path).read_text()
     else:
         cfg["_soul"] = ""
-        cfg["_soul_path"] = str(soul_path)
 
     return cfg
 
 
+# ---------------------------------------------------------------------------
+# State files
+# ---------------------------------------------------------------------------
+
+def _write_atomic(path: Path, payload: bytes) -> None:
+    """Durably replace *path*: write a temp file, fsync it, rename, fsync the dir."""
+    tmp = path.with_suffix(".tmp")
+    with tmp.open("wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
 # ---------------------------------------------------------------------------
 # Offset persistence (prevents reprocessing messages on restart)
 # ---------------------------------------------------------------------------
 
 def load_offset() -> int:
     if STATE_PATH.exists():
-        with STATE_PATH.open() as f:
-            return json.load(f).get("offset", 0)
+        return _json_loads(STATE_PATH.read_bytes()).get("offset", 0)
     return 0
 
 
 def save_offset(offset: int) -> None:
-    tmp = STATE_PATH.with_suffix(".tmp")
-    with tmp.open("w") as f:
-        json.dump({"offset": offset}, f)
-    tmp.rename(STATE_PATH)
+    _write_atomic(STATE_PATH, _json_dumps({"offset": offset}))
 
 
 # ---------------------------------------------------------------------------
 # Claude session management (per chat_id)
 # ---------------------------------------------------------------------------
 
+_MAX_SESSIONS = 1000  # chats beyond this lose their (least recently used) session
+
+
 def load_sessions() -> dict:
     if SESSIONS_PATH.exists():
-        with SESSIONS_PATH.open() as f:
-            return json.load(f)
+        return _json_loads(SESSIONS_PATH.read_bytes())
     return {}
 
 
+def touch_session(sessions: dict, key: str, session_id: str, limit: int) -> bool:
+    """Record *session_id* as the most recently used session for *key*.
+
+    Dicts keep insertion order, so re-inserting moves the chat to the end and
+    the least recently used chats are evicted from the front once there are
+    more than *limit*. Returns True if the mapping or its order changed and
+    needs saving, so eviction after a restart follows real recency; repeat
+    turns from the most recent chat need no write. Callers hold
+    _sessions_lock.
+    """
+    moved = next(reversed(sessions), None) != key
+    changed = sessions.pop(key, None) != session_id or moved
+    sessions[key] = session_id
+    while len(sessions) > limit:
+        del sessions[next(iter(sessions))]
+        changed = True
+    return changed
+
+
 def save_sessions(sessions: dict) -> None:
     SESSIONS_PATH.parent.mkdir(parents=True, exist_ok=True)
-    tmp = SESSIONS_PATH.with_suffix(".tmp")
-    with tmp.open("w") as f:
-        json.dump(sessions, f, indent=2)
-    tmp.rename(SESSIONS_PATH)
+    _write_atomic(SESSIONS_PATH, _json_dumps(sessions))
 
 
 # ---------------------------------------------------------------------------
 # Telegram API
 # ---------------------------------------------------------------------------
 
-def _base(token: str) -> str:
-    return f"https://api.telegram.org/bot{token}"
+# One pooled session for every Bot API call so long-polls, chunked replies and
+# typing indicators reuse TCP+TLS connections instead of handshaking per call.
+# Failed connects are retried for every call; 429/5xx responses only for the
+# idempotent GETs (urllib3 never replays a POST), and read timeouts never, so
+# a stalled long-poll is not silently stretched. sendMessage handles 429
+# itself in _post_message.
+_http = requests.Session()
+_http.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3, read=0, backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False,
+    ),
+))
 
 
-def tg_get_updates(token: str, offset: int, timeout: int = 30) -> list[dict]:
+@lru_cache(maxsize=16)
+def _url(token: str, method: str) -> str:
+    """Bot API endpoint URL, built once per (token, method)."""
+    return f"https://api.telegram.org/bot{token}/{method}"
+
+
+# POST bodies are serialized with _json_dumps (orjson when available) and
+# sent as raw bytes, rather than through requests' own json= encoding.
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+_POLL_TIMEOUT = 50  # seconds; Telegram holds a long-poll open for up to ~50 s
+
+# Only the update kinds dispatch_message handles, so Telegram doesn't send
+# (and we don't parse) channel posts, callbacks, reactions, polls, etc.
+_ALLOWED_UPDATES = json.dumps(["message", "edited_message"])
+
+
+def tg_get_updates(token: str, offset: int, timeout: int = _POLL_TIMEOUT) -> list[dict]:
     """Long-poll for new updates. Blocks up to `timeout` seconds."""
     try:
-        r = requests.get(
-            f"{_base(token)}/getUpdates",
-            params={"offset": offset, "timeout": timeout},
+        r = _http.get(
+            _url(token, "getUpdates"),
+            params={"offset": offset, "timeout": timeout, "allowed_updates": _ALLOWED_UPDATES},
             timeout=timeout + 10,
         )
         r.raise_for_status()
-        return r.json().get("result", [])
+        return _json_loads(r.content).get("result", [])
     except Exception as e:
         logging.error(f"getUpdates failed: {e}")
         return []
 
 
-def tg_send(token: str, chat_id: int, text: str) -> None:
-    """Send a message, splitting into chunks if it exceeds 4096 chars."""
-    for chunk in chunk_reply(text):
+_SEND_ATTEMPTS = 3
+_MAX_RETRY_AFTER = 30  # seconds; longer flood waits are logged and dropped
+
+
+def _post_message(token: str, chat_id: int, text: str) -> None:
+    """POST one sendMessage, waiting out Telegram's 429 flood control."""
+    for attempt in range(1, _SEND_ATTEMPTS + 1):
         try:
-            r = requests.post(
-                f"{_base(token)}/sendMessage",
-                json={"chat_id": chat_id, "text": chunk},
+            r = _http.post(
+                _url(token, "sendMessage"),
+                data=_json_dumps({"chat_id": chat_id, "text": text}),
+                headers=_JSON_HEADERS,
                 timeout=15,
             )
-            if not r.ok:
-                logging.warning(f"sendMessage returned {r.status_code}: {r.text[:100]}")
         except Exception as e:
             logging.error(f"sendMessage failed: {e}")
+            return
+        if r.ok:
+            return
+        if r.status_code == 429 and attempt < _SEND_ATTEMPTS:
+            try:
+                retry_after = r.json()["parameters"]["retry_after"]
+            except (ValueError, KeyError, TypeError):
+                retry_after = 1
+            if retry_after <= _MAX_RETRY_AFTER:
+                logging.info(f"sendMessage rate-limited; retrying in {retry_after}s")
+                time.sleep(retry_after)
+                continue
+        logging.warning(f"sendMessage returned {r.status_code}: {r.text[:100]}")
+        return
+
+
+def tg_send(token: str, chat_id: int, text: str) -> None:
+    """Send a message, splitting into chunks if it exceeds 4096 chars."""
+    if _fits_one(text):
+        _post_message(token, chat_id, text)
+        return
+    for chunk in chunk_reply(text):
+        _post_message(token, chat_id, chunk)
 
 
 def tg_send_typing(token: str, chat_id: int) -> None:
     """Show 'typing...' indicator while Claude is thinking."""
     try:
-        requests.post(
-            f"{_base(token)}/sendChatAction",
-            json={"chat_id": chat_id, "action": "typing"},
+        _http.post(
+            _url(token, "sendChatAction"),
+            data=_json_dumps({"chat_id": chat_id, "action": "typing"}),
+            headers=_JSON_HEADERS,
             timeout=5,
         )
     except Exception:
@@ -194,50 +325,114 @@ def tg_send_typing(token: str, chat_id: int) -> None:
 
 
 # ---------------------------------------------------------------------------
-# Reply chunking (Telegram 4096-char limit)
+# Reply chunking (Telegram 4096-char limit, counted in UTF-16 code units)
 # ---------------------------------------------------------------------------
 
 _TG_MAX_CHARS = 4096
 _CHUNK_HEADER_MAX = 8  # "[10/10] "
 
 
+def _tg_len(text: str) -> int:
+    """Length as Telegram counts it: UTF-16 code units, not code points."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _tg_cut(text: str, limit: int) -> int:
+    """Largest index i such that text[:i] fits in *limit* UTF-16 code units."""
+    i = min(limit, len(text))
+    while (excess := _tg_len(text[:i]) - limit) > 0:
+        i -= excess  # each code point is 1 or 2 units, so this never overshoots
+    return i
+
+
+# A sentence ends after ". " (the space is dropped) or at a newline.
+_SENTENCE_BREAK = re.compile(r"\. |\n")
+
+
+def _sentence_units(text: str, start: int, stop: int, chunk_size: int):
+    """Yield sentence units of the paragraph text[start:stop] (see _chunk_units).
+
+    One compiled-regex scan over the paragraph yields every break offset, so
+    the paragraph is walked once and never copied whole.
+    """
+    sep = "\n\n"
+    pos = start
+    breaks = _SENTENCE_BREAK.finditer(text, start, stop)
+    while True:
+        m = next(breaks, None)
+        if m is None:
+            end, resume = stop, -1
+        else:
+            end, resume = (m.start() + 1 if m.group() == ". " else m.start()), m.end()
+
+        while (sentence_len := _tg_len(text[pos:end])) > chunk_size:
+            cut = pos + _tg_cut(text[pos:pos + chunk_size], chunk_size)
+            yield sep, text[pos:cut], _tg_len(text[pos:cut])
+            pos = cut
+            sep = ""
+        yield sep, text[pos:end], sentence_len
+        sep = " "
+
+        if resume == -1:
+            return
+        pos = resume
+
+
+def _chunk_units(text: str, chunk_size: int):
+    """Yield (separator, piece, length) triples, each piece fitting *chunk_size*.
+
+    Pieces are paragraphs; paragraphs that are too long are broken into
+    sentences, and sentences that are still too long into hard slices.
+    Lengths are in Telegram units (see _tg_len). Boundaries are found by
+    index, so no paragraph or sentence lists are built.
+    """
+    pos = 0
+    while True:
+        brk = text.find("\n\n", pos)
+        if brk == -1:
+            brk = len(text)
+        para_len = _tg_len(text[pos:brk])
+        if para_len <= chunk_size:
+            yield "\n\n", text[pos:brk], para_len
+        else:
+            yield from _sentence_units(text, pos, brk, chunk_size)
+        if brk == len(text):
+            return
+        pos = brk + 2
+
+
+def _fits_one(text: str) -> bool:
+    """True if text fits in a single message without splitting."""
+    # Most replies are short, and for ASCII len() is already exact.
+    return len(text) <= _TG_MAX_CHARS and (text.isascii() or _tg_len(text) <= _TG_MAX_CHARS)
+
+
 def chunk_reply(text: str) -> list[str]:
-    """Split a long reply into ≤4096-char chunks, labeled [1/N] if needed."""
-    if len(text) <= _TG_MAX_CHARS:
+    """Split a long reply into ≤4096-unit chunks, labeled [1/N] if needed."""
+    if _fits_one(text):
         return [text]
 
     chunk_size = _TG_MAX_CHARS - _CHUNK_HEADER_MAX
-    paragraphs = text.split("\n\n")
     chunks: list[str] = []
-    current = ""
-
-    for para in paragraphs:
-        candidate = (current + "\n\n" + para).strip() if current else para
-        if len(candidate) <= chunk_size:
-            current = candidate
+    buf: list[str] = []  # pieces and separators of the chunk being built
+    size = 0             # Telegram length of "".join(buf), tracked without joining
+
+    for sep, piece, piece_len in _chunk_units(text, chunk_size):
+        if not piece.strip():
+            continue
+        if buf and size + len(sep) + piece_len <= chunk_size:
+            buf += (sep, piece)
+            size += len(sep) + piece_len
         else:
-            if current:
-                chunks.append(current)
-            if len(para) > chunk_size:
-                sentences = para.replace(". ", ".\n").split("\n")
-                current = ""
-                for sentence in sentences:
-                    candidate = (current + " " + sentence).strip() if current else sentence
-                    if len(candidate) <= chunk_size:
-                        current = candidate
-                    else:
-                        if current:
-                            chunks.append(current)
-                            current = ""
-                        while len(sentence) > chunk_size:
-                            chunks.append(sentence[:chunk_size])
-                            sentence = sentence[chunk_size:]
-                        current = sentence
-            else:
-                current = para
+            if buf:
+                chunks.append("".join(buf))
+            buf = [piece]
+            size = piece_len
 
-    if current:
-        chunks.append(current)
+    if buf:
+        chunks.append("".join(buf))
 
     if len(chunks) > 1:
         total = len(chunks)
@@ -250,6 +445,13 @@ def chunk_reply(text: str) -> list[str]:
 # Claude integration
 # ---------------------------------------------------------------------------
 
+_CLAUDE_CMD = ("claude", "-p", "--dangerously-skip-permissions")
+
+# Environment for claude / agent-loop.sh children, built once after .env is
+# loaded. CLAUDECODE is cleared so claude doesn't refuse to run nested.
+_CLAUDE_ENV = {**os.environ, "CLAUDECODE": ""}
+
+
 def run_claude_chat(
     prompt: str,
     session_id: str | None,
@@ -257,12 +459,7 @@ def run_claude_chat(
     system_prompt: str,
 ) -> tuple[str, str]:
     """Invoke claude -p for one chat turn. Returns (reply, new_session_id)."""
-    cmd = [
-        "claude", "-p",
-        "--dangerously-skip-permissions",
-        "--output-format", "json",
-        "--model", model,
-    ]
+    cmd = [*_CLAUDE_CMD, "--output-format", "json", "--model", model]
     if session_id:
         cmd += ["--resume", session_id]
     else:
@@ -270,25 +467,330 @@ def run_claude_chat(
     cmd.append(prompt)
 
     try:
-        env = {**os.environ, "CLAUDECODE": ""}
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300, env=env)
+        result = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=300, env=_CLAUDE_ENV,
+        )
     except subprocess.TimeoutExpired:
         return ("(Request timed out after 5 minutes. Please try again.)", session_id or "")
     except FileNotFoundError:
         return ("(Error: claude CLI not found. Is it installed and in PATH?)", "")
 
     if result.returncode != 0:
-        err = (result.stderr or result.stdout).strip()
+        err = (result.stderr or result.stdout).decode("utf-8", "replace").strip()
         logging.error(f"claude CLI failed (exit {result.returncode}): {err[:300]}")
         return ("(Claude error — check agent logs for details.)", session_id or "")
 
     try:
-        data = json.loads(result.stdout)
+        data = _json_loads(result.stdout)
         reply = data.get("result", "").strip()
         new_session = data.get("session_id", "") or session_id or ""
         return (reply or "(No response from Claude.)", new_session)
-    except json.JSONDecodeError:
-        return (result.stdout.strip()[:500] or "(Empty response.)", session_id or "")
+    except ValueError:  # JSONDecodeError, or stdout that isn't valid UTF-8
+        raw = result.stdout.decode("utf-8", "replace").strip()
+        return (raw[:500] or "(Empty response.)", session_id or "")
+
+
+# ---------------------------------------------------------------------------
+# Persistent Claude workers (one long-lived claude process per chat)
+# ---------------------------------------------------------------------------
+
+_WORKER_IDLE_SECONDS = 600
+_STREAM_FLUSH_CHARS = 3500  # forward streamed text once this much is buffered
+
+_workers: dict[int, "ClaudeWorker"] = {}
+_workers_lock = threading.Lock()
+_workers_disabled = False
+_workers_answered = False  # some worker has completed a stream-json turn
+
+
+class ClaudeWorker:
+    """A long-lived `claude -p` process that takes chat turns over stream-json.
+
+    Keeping the process alive between turns skips the CLI cold start that a
+    fresh `claude -p` pays on every message.
+    """
+
+    def __init__(
+        self, session_id: str | None, model: str, system_prompt: str, stream: bool = False,
+    ) -> None:
+        cmd = [
+            *_CLAUDE_CMD,
+            "--input-format", "stream-json",
+            "--output-format", "stream-json",
+            "--verbose",
+            "--model", model,
+        ]
+        if stream:
+            cmd.append("--include-partial-messages")
+        if session_id:
+            cmd += ["--resume", session_id]
+        else:
+            cmd += ["--system-prompt", system_prompt]
+
+        self.proc = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, text=True, bufsize=1, env=_CLAUDE_ENV,
+        )
+        self.model = model
+        self.stream = stream
+        self.session_id = session_id or ""
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+        self.retired = False  # dropped mid-turn; close once the turn ends
+        self.resumed = bool(session_id)
+        self.started = False  # emitted its first stream-json event (init)
+        self._lines: queue.Queue[str | None] = queue.Queue()
+        self._stderr: deque[str] = deque(maxlen=20)  # tail, for exit errors
+        self._stdout_reader = threading.Thread(target=self._read_stdout, daemon=True)
+        self._stdout_reader.start()
+        self._stderr_reader = threading.Thread(target=self._read_stderr, daemon=True)
+        self._stderr_reader.start()
+
+    def _read_stdout(self) -> None:
+        with self.proc.stdout:
+            for line in self.proc.stdout:
+                self.started = True
+                self._lines.put(line)
+        self._lines.put(None)  # EOF: the process exited
+
+    def _read_stderr(self) -> None:
+        with self.proc.stderr:
+            for line in self.proc.stderr:
+                line = line.rstrip()
+                if line:
+                    logging.debug(f"claude worker: {line}")
+                    self._stderr.append(line)
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def ask(
+        self, prompt: str, timeout: float, on_text: Callable[[str], None] | None = None,
+    ) -> tuple[str, str]:
+        """Send one user turn and wait for its result. Returns (reply, session_id).
+
+        With *on_text* (stream workers only), reply text is handed to it in
+        paragraph-aligned pieces as Claude writes it, and the returned reply
+        is "" unless there is something left for the caller to send.
+
+        Raises TimeoutError if no result arrives within *timeout* seconds and
+        EOFError if the process exits mid-turn; its ``streamed`` attribute is
+        true if part of the reply was already handed to *on_text*.
+        """
+        global _workers_answered
+        frame = {"type": "user", "message": {"role": "user", "content": prompt}}
+        pending = ""  # streamed text not yet handed to on_text
+        streamed = False
+        with self.lock:
+            self.last_used = time.monotonic()
+            try:
+                self.proc.stdin.write(json.dumps(frame) + "\n")
+                self.proc.stdin.flush()
+            except (BrokenPipeError, ValueError):  # ValueError: stdin closed
+                raise self._exit_error() from None
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    line = self._lines.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    raise TimeoutError(f"no result within {timeout}s") from None
+                if line is None:
+                    raise self._exit_error(streamed)
+                try:
+                    event = _json_loads(line)
+                except ValueError:  # json / orjson decode errors
+                    continue
+                if event.get("session_id"):
+                    self.session_id = event["session_id"]
+                kind = event.get("type")
+                if kind == "stream_event" and on_text:
+                    inner = event.get("event") or {}
+                    delta = inner.get("delta") or {}
+                    if delta.get("type") == "text_delta":
+                        pending += delta.get("text", "")
+                    send, pending = _split_stream_text(
+                        pending, final=inner.get("type") == "message_stop",
+                    )
+                    if send.strip():
+                        on_text(send.strip())
+                        streamed = True
+                    continue
+                if kind != "result":
+                    continue
+                _workers_answered = True
+                self.last_used = time.monotonic()
+                if event.get("is_error"):
+                    err = event.get("result") or event.get("errors") or event.get("subtype")
+                    logging.error(f"claude worker turn failed: {str(err)[:300]}")
+                    return ("(Claude error — check agent logs for details.)", self.session_id)
+                if streamed:
+                    return (pending.strip(), self.session_id)
+                reply = (event.get("result") or "").strip()
+                return (reply or "(No response from Claude.)", self.session_id)
+
+    def _exit_error(self, streamed: bool = False) -> EOFError:
+        """EOFError for an exited process.
+
+        ``streamed`` marks a partly sent reply; ``cli_unusable`` marks a fresh
+        (non --resume) process that exited before its init event, i.e. the
+        CLI can't run in stream-json mode at all.
+        """
+        try:
+            self.proc.wait(timeout=1)  # reap it so the exit code is known
+        except subprocess.TimeoutExpired:
+            pass
+        self._stdout_reader.join(timeout=1)
+        self._stderr_reader.join(timeout=1)  # let the last stderr lines land
+        err = " | ".join(self._stderr)[-300:]
+        e = EOFError(f"claude worker exited (code {self.proc.poll()}): {err}")
+        e.streamed = streamed
+        e.cli_unusable = not self.resumed and not self.started
+        return e
+
+    def close(self) -> None:
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+def _split_stream_text(pending: str, final: bool) -> tuple[str, str]:
+    """Split buffered streamed text into (send now, keep buffering).
+
+    Text is held until _STREAM_FLUSH_CHARS have accumulated and then cut at
+    the last paragraph (or line) break, so each Telegram message reads as a
+    whole; the end of an assistant message flushes whatever is left.
+    """
+    if final:
+        return pending, ""
+    if len(pending) < _STREAM_FLUSH_CHARS:
+        return "", pending
+    cut = pending.rfind("\n\n")
+    if cut <= 0:
+        cut = pending.rfind("\n")
+    if cut <= 0:
+        if len(pending) < _TG_MAX_CHARS - _CHUNK_HEADER_MAX:
+            return "", pending
+        cut = len(pending)
+    return pending[:cut], pending[cut:].lstrip("\n")
+
+
+def _get_worker(
+    chat_id: int, session_id: str | None, model: str, system_prompt: str, idle: float,
+    stream: bool = False,
+) -> ClaudeWorker:
+    """Return a live worker for *chat_id* on *session_id*, spawning one if needed."""
+    reap_idle_workers(idle)
+    stale: list[ClaudeWorker] = []
+    with _workers_lock:
+        worker = _workers.get(chat_id)
+        if worker and not (
+            worker.alive()
+            and worker.model == model
+            and worker.stream == stream
+            and worker.session_id == (session_id or "")
+        ):
+            stale.append(_workers.pop(chat_id))
+            worker = None
+        if worker is None:
+            worker = ClaudeWorker(session_id, model, system_prompt, stream)
+            _workers[chat_id] = worker
+        # Stamped under the lock so the reaper can't close the worker before
+        # ask() takes worker.lock.
+        worker.last_used = time.monotonic()
+
+    for w in stale:
+        w.close()
+    return worker
+
+
+def reap_idle_workers(idle: float) -> None:
+    """Stop workers that have not been used for *idle* seconds."""
+    now = time.monotonic()
+    with _workers_lock:
+        stale = [
+            _workers.pop(cid) for cid, w in list(_workers.items())
+            if not w.lock.locked() and now - w.last_used > idle
+        ]
+    for w in stale:
+        w.close()
+
+
+def _drop_worker(chat_id: int) -> None:
+    """Forget the chat's worker; one that is mid-turn is closed when it ends."""
+    with _workers_lock:
+        worker = _workers.pop(chat_id, None)
+        if worker and worker.lock.locked():
+            worker.retired = True
+            return
+    if worker:
+        worker.close()
+
+
+def close_workers() -> None:
+    with _workers_lock:
+        workers = list(_workers.values())
+        _workers.clear()
+    for w in workers:
+        w.close()
+
+
+def run_claude_turn(
+    chat_id: int,
+    prompt: str,
+    session_id: str | None,
+    model: str,
+    system_prompt: str,
+    cfg: dict,
+    on_text: Callable[[str], None] | None = None,
+) -> tuple[str, str]:
+    """Run one chat turn on the chat's persistent worker, falling back to claude -p.
+
+    *on_text* is only used by streaming workers (see ClaudeWorker.ask); the
+    one-shot fallback always returns the whole reply.
+    """
+    global _workers_disabled
+    if _workers_disabled or not cfg["persistent_sessions"]:
+        return run_claude_chat(prompt, session_id, model, system_prompt)
+
+    idle = cfg["worker_idle_seconds"]
+    try:
+        stream = on_text is not None
+        worker = _get_worker(chat_id, session_id, model, system_prompt, idle, stream)
+        reply, new_session = worker.ask(prompt, timeout=300, on_text=on_text)
+        if worker.retired:  # /reset mid-turn: the session is not kept
+            worker.close()
+            return reply, ""
+        return reply, new_session
+    except TimeoutError:
+        _drop_worker(chat_id)
+        return ("(Request timed out after 5 minutes. Please try again.)", session_id or "")
+    except FileNotFoundError:
+        return ("(Error: claude CLI not found. Is it installed and in PATH?)", "")
+    except (EOFError, OSError) as e:
+        if getattr(e, "streamed", False):
+            # Part of the reply already reached the user; replaying the turn
+            # one-shot would send that text a second time.
+            logging.warning(f"Claude worker for {chat_id} died mid-reply ({e})")
+            _drop_worker(chat_id)
+            return ("(Claude stopped mid-reply — check agent logs for details.)",
+                    session_id or "")
+        if getattr(e, "cli_unusable", False) and not _workers_answered:
+            # A fresh worker died before starting and none has ever answered,
+            # so the CLI can't run in stream-json mode; stop trying. Anything
+            # else (e.g. a stale --resume) only affects this chat's turn.
+            logging.warning(f"Persistent claude worker unavailable ({e}); "
+                            "using one-shot claude -p from now on")
+            _workers_disabled = True
+        else:
+            logging.warning(f"Claude worker for {chat_id} failed ({e}); retrying one-shot")
+        _drop_worker(chat_id)
+        return run_claude_chat(prompt, session_id, model, system_prompt)
 
 
 def classify_message(text: str) -> str:
@@ -300,18 +802,13 @@ def classify_message(text: str) -> str:
         f"Message: {text}\n\n"
         "Reply with exactly one word: task or chat"
     )
-    cmd = [
-        "claude", "-p",
-        "--dangerously-skip-permissions",
-        "--output-format", "json",
-        "--model", "haiku",
-        prompt,
-    ]
+    cmd = [*_CLAUDE_CMD, "--output-format", "json", "--model", "haiku", prompt]
     try:
-        env = {**os.environ, "CLAUDECODE": ""}
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30, env=env)
+        result = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30, env=_CLAUDE_ENV,
+        )
         if result.returncode == 0:
-            data = json.loads(result.stdout)
+            data = _json_loads(result.stdout)
             reply = data.get("result", "").strip().lower()
             if reply.startswith("task"):
                 return "task"
@@ -331,16 +828,16 @@ def _run_agent_loop_task(task_text: str, chat_id: int, cfg: dict) -> str:
     if not agent_loop.exists():
         return "(Error: agent-loop.sh not found next to telegram-agent.py.)"
 
-    timeout = cfg.get("task_timeout_seconds", 600)
+    timeout = cfg["task_timeout_seconds"]
     try:
-        env = {**os.environ, "CLAUDECODE": ""}
         result = subprocess.run(
-            [str(agent_loop), "--model", cfg.get("task_model", "opus"), str(task_file)],
-            capture_output=True, text=True, timeout=timeout, env=env,
+            [str(agent_loop), "--model", cfg["task_model"], str(task_file)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout, env=_CLAUDE_ENV,
         )
         if result.returncode == 0:
             return "Task completed successfully."
-        return f"Task failed: {(result.stderr or result.stdout).strip()[:300]}"
+        output = (result.stderr or result.stdout).decode("utf-8", "replace").strip()
+        return f"Task failed: {output[:300]}"
     except subprocess.TimeoutExpired:
         return f"Task timed out (exceeded {timeout}s limit)."
 
@@ -352,8 +849,7 @@ def _task_done_callback(task_text: str, chat_id: int, cfg: dict, future) -> None
     except Exception as e:
         result = f"Task error: {e}"
     finally:
-        with _active_tasks_lock:
-            _active_tasks.pop(chat_id, None)
+        _active_tasks.pop(chat_id, None)
     tg_send(token, chat_id, result)
 
 
@@ -394,10 +890,38 @@ def queue_agent_loop_task(
 # Async chat (non-blocking wrapper around run_claude_chat)
 # ---------------------------------------------------------------------------
 
-def _send_typing_loop(token: str, chat_id: int, stop_event: threading.Event) -> None:
-    """Resend the 'typing…' indicator every 4 s until *stop_event* is set."""
-    while not stop_event.wait(timeout=4):
-        tg_send_typing(token, chat_id)
+_TYPING_INTERVAL = 4  # Telegram hides the indicator after ~5 s
+
+_typing_chats: set[int] = set()
+_typing_lock = threading.Lock()
+
+
+def _typing_heartbeat(token: str) -> None:
+    """Resend 'typing…' every few seconds for every chat with a turn in flight."""
+    while True:
+        time.sleep(_TYPING_INTERVAL)
+        with _typing_lock:
+            chat_ids = list(_typing_chats)
+        for chat_id in chat_ids:
+            tg_send_typing(token, chat_id)
+
+
+def start_typing_heartbeat(token: str) -> None:
+    """Start the single background thread that keeps typing bubbles alive."""
+    threading.Thread(
+        target=_typing_heartbeat, args=(token,), name="typing-heartbeat", daemon=True,
+    ).start()
+
+
+def _new_session_prompt(cfg: dict) -> str:
+    """System prompt for a new chat session: SOUL.md + system_prompt, built once."""
+    prompt = cfg.get("_new_session_prompt")
+    if prompt is None:
+        prompt = cfg["system_prompt"]
+        if cfg["_soul"]:
+            prompt = cfg["_soul"] + "\n\n" + prompt
+        cfg["_new_session_prompt"] = prompt
+    return prompt
 
 
 def _run_chat(
@@ -407,39 +931,56 @@ def _run_chat(
     token = cfg["_token"]
     key = str(chat_id)
 
-    # Keep the typing bubble alive for the full duration of the Claude call.
-    stop_typing = threading.Event()
+    # Keep the typing bubble alive for the full duration of the Claude call;
+    # the shared heartbeat thread refreshes it while chat_id is registered.
     tg_send_typing(token, chat_id)
-    typing_thread = threading.Thread(
-        target=_send_typing_loop, args=(token, chat_id, stop_typing), daemon=True,
-    )
-    typing_thread.start()
+    with _typing_lock:
+        _typing_chats.add(chat_id)
 
     try:
-        with _sessions_lock:
-            session_id = sessions.get(key)
-        system_prompt = cfg.get("system_prompt", "You are a helpful assistant.")
+        session_id = sessions.get(key)
+        # Only used when the turn starts a new session; resumed sessions
+        # already carry their system prompt.
+        system_prompt = _new_session_prompt(cfg)
 
-        if not session_id and cfg.get("_soul"):
-            system_prompt = cfg["_soul"] + "\n\n" + system_prompt
+        # With stream_replies, text is forwarded as Claude writes it.
+        on_text = partial(tg_send, token, chat_id) if cfg["stream_replies"] else None
 
-        reply, new_session = run_claude_chat(
-            prompt, session_id, cfg.get("model", "sonnet"), system_prompt,
+        reply, new_session = run_claude_turn(
+            chat_id, prompt, session_id, cfg["model"], system_prompt, cfg,
+            on_text,
         )
 
+        # Resumed turns usually keep the same session id; only rewrite the
+        # sessions file when the mapping actually changed, and not when a
+        # /reset during the turn already dropped session_id.
         if new_session:
+            limit = cfg["max_sessions"]
             with _sessions_lock:
-                sessions[key] = new_session
-                save_sessions(sessions)
+                if (sessions.get(key) == session_id
+                        and touch_session(sessions, key, new_session, limit)):
+                    save_sessions(sessions)
 
-        tg_send(token, chat_id, reply)
+        if reply:  # empty when the whole reply was already streamed
+            tg_send(token, chat_id, reply)
     finally:
-        stop_typing.set()
-        typing_thread.join(timeout=5)
+        with _typing_lock:
+            _typing_chats.discard(chat_id)
+
+
+def _submit_chat(
+    prompt: str, chat_id: int, sessions: dict, cfg: dict, executor: ThreadPoolExecutor,
+) -> None:
+    future = executor.submit(_run_chat, prompt, chat_id, sessions, cfg)
+    future.add_done_callback(
+        lambda f: _chat_done_callback(chat_id, sessions, cfg, executor, f)
+    )
 
 
-def _chat_done_callback(chat_id: int, cfg: dict, future) -> None:
-    """Clean up active-chat tracking; surface unexpected errors."""
+def _chat_done_callback(
+    chat_id: int, sessions: dict, cfg: dict, executor: ThreadPoolExecutor, future,
+) -> None:
+    """Surface unexpected errors, then start the chat's next queued message."""
     try:
         future.result()
     except Exception as e:
@@ -450,7 +991,17 @@ def _chat_done_callback(chat_id: int, cfg: dict, future) -> None:
             pass
     finally:
         with _active_chats_lock:
-            _active_chats.pop(chat_id, None)
+            pending = _active_chats.get(chat_id)
+            if pending:
+                prompt = pending.popleft()
+            else:
+                _active_chats.pop(chat_id, None)
+                prompt = None
+        if prompt is not None:
+            try:
+                _submit_chat(prompt, chat_id, sessions, cfg, executor)
+            except RuntimeError:  # executor shut down
+                _active_chats.pop(chat_id, None)
 
 
 def queue_chat(
@@ -460,107 +1011,133 @@ def queue_chat(
     cfg: dict,
     executor: ThreadPoolExecutor,
 ) -> None:
-    """Submit a chat turn to the thread-pool and return immediately."""
+    """Submit a chat turn to the thread-pool and return immediately.
+
+    A chat runs one turn at a time: messages that arrive while a turn is in
+    flight wait in the chat's queue and run in the order they reach this
+    function, while other chats keep running concurrently. In chat mode that
+    is arrival order; in auto mode messages are classified in parallel first,
+    so two quick messages are queued in the order classification finishes.
+    """
     with _active_chats_lock:
-        if chat_id in _active_chats:
-            tg_send(
-                cfg["_token"], chat_id,
-                "Still thinking about your previous message…",
-            )
+        pending = _active_chats.get(chat_id)
+        if pending is not None:
+            pending.append(prompt)
             return
-        _active_chats[chat_id] = True
+        _active_chats[chat_id] = deque()
 
-    future = executor.submit(_run_chat, prompt, chat_id, sessions, cfg)
-    future.add_done_callback(
-        lambda f: _chat_done_callback(chat_id, cfg, f)
-    )
+    _submit_chat(prompt, chat_id, sessions, cfg, executor)
 
 
 # ---------------------------------------------------------------------------
 # Command handling
 # ---------------------------------------------------------------------------
 
-def handle_command(text: str, chat_id: int, sessions: dict, cfg: dict) -> None:
-    token = cfg["_token"]
-    parts = text.split(None, 1)
-    cmd = parts[0].lower().split("@")[0]  # strip @botname suffix if present
-    args = parts[1].strip() if len(parts) > 1 else ""
-
-    if cmd == "/reset":
-        key = str(chat_id)
-        with _sessions_lock:
-            if key in sessions:
-                del sessions[key]
-                save_sessions(sessions)
-        tg_send(token, chat_id, "Session reset. Starting fresh.")
-
-    elif cmd == "/mode":
-        if args in ("auto", "chat", "task"):
-            cfg["mode"] = args
-            tg_send(token, chat_id, f"Switched to {args} mode.")
-        else:
-            tg_send(token, chat_id, "Usage: /mode auto | /mode chat | /mode task")
-
-    elif cmd == "/status":
-        with _active_tasks_lock:
-            running = list(_active_tasks.values())
-        lines = [
-            f"Mode: {cfg.get('mode', 'auto')}",
-            f"Model: {cfg.get('model', 'sonnet')}",
-            f"Active chat sessions: {len(sessions)}",
-        ]
-        if running:
-            for i, t in enumerate(running, 1):
-                lines.append(f"Running task {i}: {t[:80]}")
-        else:
-            lines.append("No task running.")
-        tg_send(token, chat_id, "\n".join(lines))
-
-    elif cmd == "/help":
-        tg_send(token, chat_id,
-            "/reset — clear this conversation and start fresh\n"
-            "/mode auto — auto-detect chat vs agent loop (default)\n"
-            "/mode chat — force direct conversation with Claude\n"
-            "/mode task — force all messages through agent-loop.sh\n"
-            "/status — show current mode, model, and task state\n"
-            "/help — show this message\n\n"
-            "Anything else is routed automatically."
-        )
+def _cmd_reset(args: str, chat_id: int, sessions: dict, cfg: dict) -> None:
+    key = str(chat_id)
+    with _sessions_lock:
+        if key in sessions:
+            del sessions[key]
+            save_sessions(sessions)
+    _drop_worker(chat_id)
+    tg_send(cfg["_token"], chat_id, "Session reset. Starting fresh.")
+
+
+def _cmd_mode(args: str, chat_id: int, sessions: dict, cfg: dict) -> None:
+    if args in ("auto", "chat", "task"):
+        cfg["mode"] = args
+        tg_send(cfg["_token"], chat_id, f"Switched to {args} mode.")
+    else:
+        tg_send(cfg["_token"], chat_id, "Usage: /mode auto | /mode chat | /mode task")
+
 
+def _cmd_status(args: str, chat_id: int, sessions: dict, cfg: dict) -> None:
+    with _active_tasks_lock:
+        running = list(_active_tasks.values())
+    lines = [
+        f"Mode: {cfg['mode']}",
+        f"Model: {cfg['model']}",
+        f"Active chat sessions: {len(sessions)}",
+    ]
+    if running:
+        for i, t in enumerate(running, 1):
+            lines.append(f"Running task {i}: {t[:80]}")
     else:
-        tg_send(token, chat_id, f"Unknown command: {cmd}. Try /help.")
+        lines.append("No task running.")
+    tg_send(cfg["_token"], chat_id, "\n".join(lines))
+
+
+_HELP_TEXT = (
+    "/reset — clear this conversation and start fresh\n"
+    "/mode auto — auto-detect chat vs agent loop (default)\n"
+    "/mode chat — force direct conversation with Claude\n"
+    "/mode task — force all messages through agent-loop.sh\n"
+    "/status — show current mode, model, and task state\n"
+    "/help — show this message\n\n"
+    "Anything else is routed automatically."
+)
+
+
+def _cmd_help(args: str, chat_id: int, sessions: dict, cfg: dict) -> None:
+    tg_send(cfg["_token"], chat_id, _HELP_TEXT)
+
+
+_COMMANDS: dict[str, Callable[[str, int, dict, dict], None]] = {
+    "/reset": _cmd_reset,
+    "/mode": _cmd_mode,
+    "/status": _cmd_status,
+    "/help": _cmd_help,
+}
+
+# "/cmd", "/cmd@botname", optionally followed by whitespace and arguments
+_COMMAND_RE = re.compile(r"(/\w+)(?:@\w+)?(?:\s+(.*))?", re.DOTALL)
+
+
+def handle_command(text: str, chat_id: int, sessions: dict, cfg: dict) -> None:
+    m = _COMMAND_RE.fullmatch(text)
+    cmd = m.group(1).lower() if m else text.split(None, 1)[0]
+    handler = _COMMANDS.get(cmd) if m else None
+    if handler is None:
+        tg_send(cfg["_token"], chat_id, f"Unknown command: {cmd}. Try /help.")
+        return
+    handler((m.group(2) or "").strip(), chat_id, sessions, cfg)
 
 
 # ---------------------------------------------------------------------------
 # Message dispatch
 # ---------------------------------------------------------------------------
 
+_EMPTY: dict = {}  # shared stand-in for a missing "from"; never mutated
+
 def dispatch_message(
     msg: dict, sessions: dict, cfg: dict,
     chat_executor: ThreadPoolExecutor, task_executor: ThreadPoolExecutor,
     classify_executor: ThreadPoolExecutor,
 ) -> None:
-    chat_id: int = msg["chat"]["id"]
-    from_id: int = msg.get("from", {}).get("id", 0)
-    text: str = (msg.get("text") or "").strip()
-    username: str = msg.get("from", {}).get("username", str(from_id))
-
-    if not text:
-        return  # ignore non-text messages (photos, stickers, etc.)
+    sender: dict = msg.get("from") or _EMPTY
+    from_id: int = sender.get("id", 0)
 
-    # Authorization check
+    # Authorization check first, so messages from strangers cost nothing more
     allowed = cfg["_allowed_ids"]
     if allowed and from_id not in allowed:
-        logging.debug(f"Ignoring message from unauthorized user {from_id} (@{username})")
+        logging.debug(f"Ignoring message from unauthorized user {from_id} "
+                      f"(@{sender.get('username') or from_id})")
         return
 
+    text: str = msg.get("text") or ""
+    text = text.strip()
+    if not text:
+        return  # ignore non-text messages (photos, stickers, etc.)
+
+    chat_id: int = msg["chat"]["id"]
+    username: str = sender.get("username") or str(from_id)
     logging.info(f"Message from @{username} [{from_id}]: {text[:80]}")
 
     if text.startswith("/"):
         handle_command(text, chat_id, sessions, cfg)
         return
 
-    mode = cfg.get("mode", "auto")
+    mode = cfg["mode"]
     if mode == "task":
         queue_agent_loop_task(text, chat_id, cfg, task_executor)
     elif mode == "chat":
@@ -586,10 +1163,12 @@ def main() -> None:
     token = cfg["_token"]
 
     logging.info("telegram-agent starting")
-    logging.info(f"Mode: {cfg.get('mode', 'auto')} | Model: {cfg.get('model', 'sonnet')}")
+    logging.info(f"Mode: {cfg['mode']} | Model: {cfg['model']}")
     logging.info(f"Allowed user IDs: {cfg['_allowed_ids'] or 'ALL (no restriction!)'}")
     if cfg["_soul"]:
         logging.info(f"SOUL.md loaded from {cfg['_soul_path']}")
+    elif not cfg["_soul_path"]:
+        logging.info("SOUL.md disabled (soul_path is empty)")
     else:
         logging.info(f"SOUL.md not found at {cfg['_soul_path']} — running without soul")
 
@@ -599,7 +1178,7 @@ def main() -> None:
 
     # Verify token with a lightweight API call
     try:
-        r = requests.get(f"{_base(token)}/getMe", timeout=10)
+        r = _http.get(_url(token, "getMe"), timeout=10)
         r.raise_for_status()
         bot = r.json()["result"]
         logging.info(f"Connected as @{bot['username']} (id={bot['id']})")
@@ -607,20 +1186,50 @@ def main() -> None:
         logging.error(f"Failed to connect to Telegram: {e}")
         sys.exit(1)
 
-    logging.info("Polling for messages (long-poll, timeout=30s)...")
+    start_typing_heartbeat(token)
+    logging.info(f"Polling for messages (long-poll, timeout={_POLL_TIMEOUT}s)...")
 
     # Separate executors so long-running tasks can never starve chat messages.
     # classify_executor runs Haiku classification before routing in auto mode.
-    chat_executor = ThreadPoolExecutor(max_workers=4)
-    task_executor = ThreadPoolExecutor(max_workers=2)
+    # Each chat has at most one turn in flight, so chat_workers is the number
+    # of chats that can talk to Claude at the same time.
+    chat_executor = ThreadPoolExecutor(max_workers=cfg["chat_workers"])
+    task_executor = ThreadPoolExecutor(max_workers=cfg["task_workers"])
     classify_executor = ThreadPoolExecutor(max_workers=2)
+    # One long-poll is always outstanding: the next getUpdates is issued as
+    # soon as a batch arrives and its offset is known, and runs while that
+    # batch is dispatched. Only one poll is in flight at a time, so offsets
+    # stay serialized. Poll threads are daemons so Ctrl-C exits immediately
+    # instead of waiting out an idle long-poll.
+    polled: queue.Queue[list[dict]] = queue.Queue()
+
+    def start_poll(offset: int) -> None:
+        threading.Thread(
+            target=lambda: polled.put(tg_get_updates(token, offset)), daemon=True,
+        ).start()
+
+    start_poll(offset)
+    polling = True
     try:
         while True:
             try:
-                updates = tg_get_updates(token, offset, timeout=30)
+                updates = polled.get()
+                polling = False
+                # Runs at least once per long-poll, so idle claude workers
+                # are stopped even when no new messages arrive.
+                reap_idle_workers(cfg["worker_idle_seconds"])
+                if updates:
+                    # One offset write per batch. It is saved before
+                    # dispatching, as before, so a crash mid-batch never
+                    # replays a message (and re-runs its task) on restart.
+                    # offset only advances once the write succeeded, so a
+                    # failed save re-polls and redelivers the batch.
+                    next_offset = updates[-1]["update_id"] + 1
+                    save_offset(next_offset)
+                    offset = next_offset
+                start_poll(offset)
+                polling = True
                 for update in updates:
-                    offset = update["update_id"] + 1
-                    save_offset(offset)
                     msg = update.get("message") or update.get("edited_message")
                     if msg:
                         try:
@@ -635,12 +1244,16 @@ def main() -> None:
             except Exception as e:
                 logging.error(f"Polling error: {e}", exc_info=True)
                 time.sleep(5)
+                if not polling:
+                    start_poll(offset)
+                    polling = True
     except KeyboardInterrupt:
         logging.info("Shutting down.")
     finally:
         chat_executor.shutdown(wait=False)
         task_executor.shutdown(wait=False)
         classify_executor.shutdown(wait=False)
+        close_workers()
 
 
 if __name__ == "__main__":
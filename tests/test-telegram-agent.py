@@ -3,7 +3,9 @@
 Smoke tests for telegram-agent.py — no Telegram token or Claude needed.
 Tests the executor separation, per-chat deduplication, and dispatch routing.
 """
+import os
 import sys
+import tempfile
 import threading
 import time
 import types
@@ -22,7 +24,13 @@ sys.modules["dotenv"] = dotenv_mod
 
 # Fake requests (we'll replace per-test where needed)
 requests_mod = types.ModuleType("requests")
+requests_mod.Session = MagicMock
+requests_adapters_mod = types.ModuleType("requests.adapters")
+requests_adapters_mod.HTTPAdapter = MagicMock
+requests_adapters_mod.Retry = MagicMock
+requests_mod.adapters = requests_adapters_mod
 sys.modules["requests"] = requests_mod
+sys.modules["requests.adapters"] = requests_adapters_mod
 
 import importlib.util
 import pathlib
@@ -48,9 +56,22 @@ def _make_cfg(mode="chat"):
         "model": "sonnet",
         "system_prompt": "You are a helpful assistant.",
         "task_timeout_seconds": 5,
+        "task_model": "opus",
+        "persistent_sessions": True,
+        "worker_idle_seconds": 600,
+        "stream_replies": False,
+        "max_sessions": 1000,
+        "chat_workers": 4,
+        "task_workers": 2,
     }
 
 
+def _idle_worker():
+    worker = MagicMock(retired=False)
+    worker.lock.locked.return_value = False
+    return worker
+
+
 def _make_msg(chat_id=1, from_id=1, text="hello"):
     return {
         "chat": {"id": chat_id},
@@ -115,7 +136,7 @@ class TestDispatchRouting(unittest.TestCase):
         chat_exec.submit.return_value = MagicMock()
 
         with patch.object(ta, "tg_send"):
-            ta.dispatch_message(_make_msg(), {}, cfg, chat_exec, task_exec)
+            ta.dispatch_message(_make_msg(), {}, cfg, chat_exec, task_exec, MagicMock())
 
         chat_exec.submit.assert_called_once()
         task_exec.submit.assert_not_called()
@@ -127,14 +148,28 @@ class TestDispatchRouting(unittest.TestCase):
         task_exec.submit.return_value = MagicMock()
 
         with patch.object(ta, "tg_send"):
-            ta.dispatch_message(_make_msg(), {}, cfg, chat_exec, task_exec)
+            ta.dispatch_message(_make_msg(), {}, cfg, chat_exec, task_exec, MagicMock())
 
         task_exec.submit.assert_called_once()
         chat_exec.submit.assert_not_called()
 
 
+    def test_unauthorized_sender_ignored(self):
+        cfg = _make_cfg(mode="chat")
+        cfg["_allowed_ids"] = frozenset({99})
+        chat_exec = MagicMock()
+
+        with patch.object(ta, "tg_send") as send:
+            ta.dispatch_message(_make_msg(from_id=1), {}, cfg,
+                                chat_exec, MagicMock(), MagicMock())
+
+        chat_exec.submit.assert_not_called()
+        send.assert_not_called()
+
+
 class TestPerChatDeduplication(unittest.TestCase):
-    """A second message for the same chat_id while one is in-flight is rejected."""
+    """A second task for the same chat_id while one is in-flight is rejected;
+    a second chat message waits its turn."""
 
     def setUp(self):
         ta._active_tasks.clear()
@@ -151,15 +186,299 @@ class TestPerChatDeduplication(unittest.TestCase):
 
         self.assertTrue(any("already running" in m for m in sent))
 
-    def test_duplicate_chat_rejected(self):
+    def test_duplicate_chat_queued_in_order(self):
         cfg = _make_cfg(mode="chat")
-        sent = []
+        executor = MagicMock()
+        done = []
+        executor.submit.side_effect = lambda fn, prompt, *a: done.append(prompt) or MagicMock()
+
+        with patch.object(ta, "tg_send") as send:
+            ta.queue_chat("first", 42, {}, cfg, executor)
+            ta.queue_chat("second", 42, {}, cfg, executor)
+            ta.queue_chat("third", 42, {}, cfg, executor)
+            self.assertEqual(done, ["first"])
+
+            finished = MagicMock()
+            ta._chat_done_callback(42, {}, cfg, executor, finished)
+            self.assertEqual(done, ["first", "second"])
+            ta._chat_done_callback(42, {}, cfg, executor, finished)
+            ta._chat_done_callback(42, {}, cfg, executor, finished)
+
+        self.assertEqual(done, ["first", "second", "third"])
+        self.assertNotIn(42, ta._active_chats)
+        send.assert_not_called()
+
+    def test_other_chats_not_blocked(self):
+        cfg = _make_cfg(mode="chat")
+        executor = MagicMock()
+
+        with patch.object(ta, "tg_send"):
+            ta.queue_chat("hi", 42, {}, cfg, executor)
+            ta.queue_chat("hi", 43, {}, cfg, executor)
+
+        self.assertEqual(executor.submit.call_count, 2)
+
+
+class TestSessionLRU(unittest.TestCase):
+    """touch_session keeps the most recently used chats and reports changes."""
+
+    def test_unchanged_session_needs_no_save(self):
+        sessions = {"1": "a", "2": "b"}
+        self.assertFalse(ta.touch_session(sessions, "2", "b", limit=10))
+        self.assertEqual(list(sessions), ["1", "2"])
+
+    def test_reordered_session_is_saved(self):
+        sessions = {"1": "a", "2": "b"}
+        self.assertTrue(ta.touch_session(sessions, "1", "a", limit=10))
+        self.assertEqual(list(sessions), ["2", "1"])
+
+    def test_least_recently_used_evicted(self):
+        sessions = {"1": "a", "2": "b"}
+        ta.touch_session(sessions, "1", "a", limit=2)
+        self.assertTrue(ta.touch_session(sessions, "3", "c", limit=2))
+        self.assertEqual(sessions, {"1": "a", "3": "c"})
 
+
+class TestHandleCommand(unittest.TestCase):
+    """handle_command must parse /cmd@bot args and route via the dispatch table."""
+
+    def _run(self, text, cfg):
+        sent = []
         with patch.object(ta, "tg_send", side_effect=lambda _t, _c, m: sent.append(m)):
-            ta._active_chats[42] = True
-            ta.queue_chat("hi again", 42, {}, cfg, MagicMock())
+            ta.handle_command(text, 1, {}, cfg)
+        return sent
+
+    def test_mode_with_bot_suffix(self):
+        cfg = _make_cfg(mode="chat")
+        sent = self._run("/MODE@pulsar_bot   task", cfg)
+        self.assertEqual(cfg["mode"], "task")
+        self.assertEqual(sent, ["Switched to task mode."])
+
+    def test_unknown_command(self):
+        sent = self._run("/frobnicate now", _make_cfg())
+        self.assertEqual(sent, ["Unknown command: /frobnicate. Try /help."])
+
+
+class TestClaudeWorkerFallback(unittest.TestCase):
+    """run_claude_turn must fall back to one-shot claude -p if the worker dies."""
+
+    def setUp(self):
+        ta._workers.clear()
+        ta._workers_disabled = False
+        ta._workers_answered = False
+
+    def tearDown(self):
+        ta._workers.clear()
+        ta._workers_disabled = False
+        ta._workers_answered = False
+
+    def test_worker_reply_is_used(self):
+        worker = _idle_worker()
+        worker.ask.return_value = ("hi", "sess-1")
+        with patch.object(ta, "_get_worker", return_value=worker), \
+             patch.object(ta, "run_claude_chat") as one_shot:
+            reply = ta.run_claude_turn(1, "hello", None, "sonnet", "sys", _make_cfg())
+        self.assertEqual(reply, ("hi", "sess-1"))
+        one_shot.assert_not_called()
+
+    def test_reaper_skips_busy_workers(self):
+        idle, busy = MagicMock(last_used=0), MagicMock(last_used=0)
+        idle.lock.locked.return_value = False
+        busy.lock.locked.return_value = True
+        ta._workers.update({1: idle, 2: busy})
+        ta.reap_idle_workers(idle=60)
+        self.assertEqual(list(ta._workers), [2])
+        idle.close.assert_called_once()
+        busy.close.assert_not_called()
+
+    def test_dead_worker_falls_back_to_one_shot(self):
+        worker = _idle_worker()
+        err = EOFError("exited")
+        err.cli_unusable = True  # fresh worker died before its init event
+        worker.ask.side_effect = err
+        ta._workers[1] = worker
+        with patch.object(ta, "_get_worker", return_value=worker), \
+             patch.object(ta, "run_claude_chat", return_value=("ok", "s")) as one_shot:
+            reply = ta.run_claude_turn(1, "hello", None, "sonnet", "sys", _make_cfg())
+        self.assertEqual(reply, ("ok", "s"))
+        one_shot.assert_called_once()
+        self.assertTrue(ta._workers_disabled)
+        worker.close.assert_called_once()
+
+    def test_drop_busy_worker_waits_for_turn(self):
+        worker = _idle_worker()
+        worker.lock.locked.return_value = True  # mid-turn, e.g. during /reset
+        ta._workers[1] = worker
+        ta._drop_worker(1)
+        self.assertNotIn(1, ta._workers)
+        worker.close.assert_not_called()
+        self.assertTrue(worker.retired)
+
+        worker.ask.return_value = ("hi", "old-session")
+        with patch.object(ta, "_get_worker", return_value=worker):
+            reply = ta.run_claude_turn(1, "hello", "old-session", "sonnet", "sys", _make_cfg())
+        self.assertEqual(reply, ("hi", ""))  # session not re-saved after /reset
+        worker.close.assert_called_once()
+
+    def test_streamed_turn_not_replayed(self):
+        ta._workers_answered = True
+        worker = _idle_worker()
+        err = EOFError("exited")
+        err.streamed = True
+        worker.ask.side_effect = err
+        with patch.object(ta, "_get_worker", return_value=worker), \
+             patch.object(ta, "run_claude_chat") as one_shot:
+            reply, _ = ta.run_claude_turn(1, "hello", "s", "sonnet", "sys",
+                                          _make_cfg(), on_text=MagicMock())
+        one_shot.assert_not_called()
+        self.assertIn("mid-reply", reply)
+
+    def test_failed_resume_keeps_workers_enabled(self):
+        worker = _idle_worker()
+        err = EOFError("exited")
+        err.cli_unusable = False  # started with --resume
+        worker.ask.side_effect = err
+        ta._workers[2] = worker
+        with patch.object(ta, "_get_worker", return_value=worker), \
+             patch.object(ta, "run_claude_chat", return_value=("ok", "s")) as one_shot:
+            reply = ta.run_claude_turn(2, "hello", "stale", "sonnet", "sys", _make_cfg())
+        self.assertEqual(reply, ("ok", "s"))
+        one_shot.assert_called_once()
+        self.assertFalse(ta._workers_disabled)
+        self.assertNotIn(2, ta._workers)
+
+
+_FAKE_CLAUDE = r"""#!{python}
+import json, sys, time
+
+def emit(event):
+    print(json.dumps(event), flush=True)
+
+args = sys.argv[1:]
+session = args[args.index("--resume") + 1] if "--resume" in args else "sess-1"
+if session == "stale":
+    sys.stderr.write("No conversation found with session ID: stale\n")
+    sys.exit(1)
+emit({{"type": "system", "subtype": "init", "session_id": session}})
+for line in sys.stdin:
+    prompt = json.loads(line)["message"]["content"]
+    if prompt == "die":
+        sys.stderr.write("fatal: worker crashed\n")
+        sys.exit(2)
+    if prompt == "hang":
+        time.sleep(30)
+    if prompt == "stream":
+        for text in ("Hello, ", "world."):
+            emit({{"type": "stream_event", "session_id": session, "event": {{
+                "type": "content_block_delta",
+                "delta": {{"type": "text_delta", "text": text}}}}}})
+        emit({{"type": "stream_event", "session_id": session,
+              "event": {{"type": "message_stop"}}}})
+    emit({{"type": "assistant", "session_id": session}})
+    emit({{"type": "result", "session_id": session, "is_error": prompt == "fail",
+          "result": "boom" if prompt == "fail" else "echo: " + prompt}})
+"""
+
 
-        self.assertTrue(any("thinking" in m.lower() for m in sent))
+class TestClaudeWorkerProcess(unittest.TestCase):
+    """ClaudeWorker speaks stream-json to a fake `claude` on PATH."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        script = pathlib.Path(self._tmp.name) / "claude"
+        script.write_text(_FAKE_CLAUDE.format(python=sys.executable))
+        script.chmod(0o755)
+        env = {**ta._CLAUDE_ENV, "PATH": f"{self._tmp.name}{os.pathsep}{os.environ['PATH']}"}
+        self._env = patch.object(ta, "_CLAUDE_ENV", env)
+        self._env.start()
+        self.workers = []
+        ta._workers.clear()
+        ta._workers_disabled = False
+        ta._workers_answered = False
+
+    def tearDown(self):
+        for w in self.workers:
+            w.close()
+        ta.close_workers()
+        ta._workers_disabled = False
+        ta._workers_answered = False
+        self._env.stop()
+        self._tmp.cleanup()
+
+    def _worker(self, session_id=None, stream=False):
+        w = ta.ClaudeWorker(session_id, "sonnet", "sys", stream)
+        self.workers.append(w)
+        return w
+
+    def test_reply_and_session_id(self):
+        w = self._worker()
+        self.assertEqual(w.ask("hello", timeout=10), ("echo: hello", "sess-1"))
+        self.assertEqual(w.ask("again", timeout=10), ("echo: again", "sess-1"))
+        self.assertTrue(ta._workers_answered)
+
+    def test_stream_flushed_on_message_stop(self):
+        w = self._worker(stream=True)
+        sent = []
+        self.assertEqual(w.ask("stream", timeout=10, on_text=sent.append), ("", "sess-1"))
+        self.assertEqual(sent, ["Hello, world."])
+
+    def test_error_result_is_logged(self):
+        w = self._worker()
+        with self.assertLogs(level="ERROR") as logs:
+            reply, _ = w.ask("fail", timeout=10)
+        self.assertIn("Claude error", reply)
+        self.assertIn("boom", logs.output[0])
+
+    def test_exit_mid_turn(self):
+        w = self._worker()
+        with self.assertRaises(EOFError) as cm:
+            w.ask("die", timeout=10)
+        self.assertIn("code 2", str(cm.exception))
+        self.assertIn("worker crashed", str(cm.exception))
+        self.assertFalse(cm.exception.cli_unusable)
+
+    def test_timeout(self):
+        w = self._worker()
+        with self.assertRaises(TimeoutError):
+            w.ask("hang", timeout=0.5)
+
+    def test_stale_resume_falls_back_for_that_turn_only(self):
+        with patch.object(ta, "run_claude_chat", return_value=("ok", "new")) as one_shot, \
+             self.assertLogs(level="WARNING"):
+            reply = ta.run_claude_turn(1, "hello", "stale", "sonnet", "sys", _make_cfg())
+        self.assertEqual(reply, ("ok", "new"))
+        one_shot.assert_called_once()
+        self.assertFalse(ta._workers_disabled)
+
+
+class TestStreamSplit(unittest.TestCase):
+    """Streamed text is held back until it can be cut at a paragraph break."""
+
+    def test_short_text_is_buffered(self):
+        self.assertEqual(ta._split_stream_text("hello", final=False), ("", "hello"))
+
+    def test_final_flushes_everything(self):
+        self.assertEqual(ta._split_stream_text("hello", final=True), ("hello", ""))
+
+    def test_long_text_cut_at_paragraph(self):
+        text = "a" * 3000 + "\n\n" + "b" * 1000
+        send, keep = ta._split_stream_text(text, final=False)
+        self.assertEqual(send, "a" * 3000)
+        self.assertEqual(keep, "b" * 1000)
+
+
+class TestSendRetry(unittest.TestCase):
+    """sendMessage must wait out a 429 using Telegram's retry_after."""
+
+    def test_429_retried_after_delay(self):
+        limited = MagicMock(ok=False, status_code=429)
+        limited.json.return_value = {"parameters": {"retry_after": 2}}
+        sent = MagicMock(ok=True, status_code=200)
+        with patch.object(ta._http, "post", side_effect=[limited, sent]) as post, \
+             patch.object(ta.time, "sleep") as sleep:
+            ta.tg_send("fake-token", 1, "hello")
+        self.assertEqual(post.call_count, 2)
+        sleep.assert_called_once_with(2)
 
 
 class TestChunkReply(unittest.TestCase):
@@ -178,6 +497,14 @@ class TestChunkReply(unittest.TestCase):
         for chunk in chunks:
             self.assertLessEqual(len(chunk), 4096)
 
+    def test_limit_counts_utf16_units(self):
+        # 3000 emoji are 3000 code points but 6000 UTF-16 units for Telegram
+        text = "\U0001F600" * 3000
+        chunks = ta.chunk_reply(text)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk.encode("utf-16-le")) // 2, 4096)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)